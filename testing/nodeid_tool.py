@@ -24,9 +24,16 @@ def sha3_hex(seed):
 topriv = sha3_hex
 
 
+# privkey -> pubkey, the EC multiplication is the costly part of every lookup
+_pubkeys = {}
+
+
 def _privtopub(privkey):
-    r = encode_pubkey(privtopub(privkey), 'bin_electrum')
-    assert len(r) == 64
+    r = _pubkeys.get(privkey)
+    if r is None:
+        r = encode_pubkey(privtopub(privkey), 'bin_electrum')
+        assert len(r) == 64
+        _pubkeys[privkey] = r
     return r
 
 
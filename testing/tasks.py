@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 
+import os
+import re
 import sys
+import math
 import time
 import json
+import pipes
+import tempfile
+import atexit
+import shlex
 import logging
-import boto.ec2
-import nodeid_tool
+import threading
+import subprocess
 import ConfigParser
 import concurrent.futures as futures
+from collections import defaultdict
+from functools import partial
 from os.path import expanduser
+from urlparse import urlparse
 from progressbar import ProgressBar, Percentage, Bar, Timer, ETA
 from contextlib import contextmanager
 from fabric.state import output
@@ -21,22 +31,43 @@ class FabricException(Exception):
 env.abort_exception = FabricException
 # env.warn_only = True
 
-# Load .boto config file
 user_home = expanduser("~")
-config = ConfigParser.ConfigParser()
-config.read([str(user_home + "/.boto")])
 
-# Get the credentials
-AWS_ACCESS_KEY = config.get('Credentials', 'aws_access_key_id')
-AWS_SECRET_KEY = config.get('Credentials', 'aws_secret_access_key')
-
-# Warn if no credentials
-if AWS_ACCESS_KEY is None or AWS_SECRET_KEY is None:
-    logger.info("No AWS credentials set. Please set them in ~/.boto")
-    raise SystemExit
+# AWS credentials, loaded on first use by aws_credentials()
+_CREDENTIALS = None
 
 implementations = ["cpp", "go", "python"]
 
+# Upper bound on concurrent per-node operations
+MAX_WORKERS = 16
+
+# Upper bound on concurrent batches of docker-machine create, keeping EC2 API calls in check
+LAUNCH_WORKERS = 12
+
+# Seconds to wait for prepare nodes to be launched, and for their AMIs to be created
+PREPARE_LAUNCH_TIMEOUT = 900
+PREPARE_TIMEOUT = 3600
+
+# Parse `export DOCKER_*="..."` lines from `docker-machine env`
+_ENV_EXPORT = re.compile(r'^export (DOCKER_\w+)="?([^"\n]*)"?$', re.M)
+_ENV_KEYS = (('tls', 'DOCKER_TLS_VERIFY'),
+             ('cert_path', 'DOCKER_CERT_PATH'),
+             ('host', 'DOCKER_HOST'))
+
+# Parsed `docker-machine env` results, keyed by nodename,
+# also persisted to disk to be shared across fab invocations
+_ENV_CACHE = {}
+ENV_CACHE_TTL = 3600  # seconds, None to never expire
+ENV_CACHE_DIR = os.path.join(user_home, ".cache", "system-testing")
+
+# Thread pool shared by all tasks, created by get_pool()
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# Shared boto EC2 connections, keyed by region
+_EC2 = {}
+_EC2_LOCK = threading.Lock()
+
 widgets = ['Progress: ', Percentage(), '   ', Timer(), ' ', Bar(marker='#', left='[', right=']'), ' ', ETA()]
 completed = 0
 
@@ -78,33 +109,151 @@ def rollback(nodenames):
         teardown(nodenames)
         abort("Bad failure...")
 
+def get_pool():
+    """
+    Get the thread pool shared across tasks, creating it on first use
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+            atexit.register(_POOL.shutdown)
+        return _POOL
+
+def abandon(future_to_key, what, timeout):
+    """
+    Log and cancel what is left of timed out futures, exiting so rollback() tears nodes down
+    """
+    unfinished = [key for future, key in future_to_key.items() if not future.done()]
+    for future in future_to_key:
+        future.cancel()  # only stops the ones not started yet
+    logger.info("%s timed out after %ss, unfinished: %s" % (what, timeout, ", ".join(unfinished)))
+    append_log("%s timed out after %ss, unfinished: %s" % (what, timeout, ", ".join(unfinished)))
+    raise SystemExit
+
+def submit_bounded(executor, calls, max_inflight, timeout=None):
+    """
+    Submit (key, callable) pairs keeping at most max_inflight futures pending,
+    yielding (key, future) as they complete
+
+    If nothing completes within timeout, log the unfinished keys and keep waiting,
+    every call is always submitted
+    """
+    calls = iter(calls)
+    pending = {}
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max_inflight:
+            try:
+                key, fn = next(calls)
+            except StopIteration:
+                exhausted = True
+            else:
+                pending[executor.submit(fn)] = key
+        if not pending:
+            return
+        done, _ = futures.wait(pending, timeout, return_when=futures.FIRST_COMPLETED)
+        if not done:
+            append_log("Still waiting after %ss for: %s" % (timeout, ", ".join(map(str, pending.values()))))
+            continue
+        for future in done:
+            yield pending.pop(future), future
+
 def machine_env(nodename):
-    env_ = {}
+    cached = _ENV_CACHE.get(nodename) or _load_env(nodename)
+    if cached is not None:
+        timestamp, env_ = cached
+        if ENV_CACHE_TTL is None or time.time() - timestamp < ENV_CACHE_TTL:
+            _ENV_CACHE[nodename] = cached
+            return env_
+    env_ = _machine_env(nodename)
+    if env_:
+        _ENV_CACHE[nodename] = (time.time(), env_)
+        _save_env(nodename, *_ENV_CACHE[nodename])
+    return env_
+
+def invalidate_env(nodename):
+    _ENV_CACHE.pop(nodename, None)
+    try:
+        os.remove(_env_cache_path(nodename))
+    except OSError:
+        pass
+
+def _env_cache_path(nodename):
+    return os.path.join(ENV_CACHE_DIR, "env-%s.json" % nodename)
+
+def _load_env(nodename):
+    try:
+        with open(_env_cache_path(nodename)) as f:
+            cached = json.load(f)
+        return cached['timestamp'], cached['env']
+    except (IOError, ValueError, KeyError):
+        return None
+
+def _save_env(nodename, timestamp, env_):
+    path = _env_cache_path(nodename)
+    try:
+        if not os.path.isdir(ENV_CACHE_DIR):
+            os.makedirs(ENV_CACHE_DIR)
+        # Unique temp file, other fab processes may be writing the same entry
+        fd, tmp = tempfile.mkstemp(prefix="env-%s." % nodename, suffix=".tmp", dir=ENV_CACHE_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'timestamp': timestamp, 'env': env_}, f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logger.debug("Could not cache environment for %s: %r" % (nodename, e))
+
+def _machine_env(nodename):
     env_export = machine("env %s" % nodename)
-    exports = env_export.splitlines()
-    for export in exports:
-        export = export[7:]  # remove "export "...
-        if export.startswith("DOCKER_TLS_VERIFY"):
-            logger.debug(export)
-            tls = export.split("=")[-1]
-        if export.startswith("DOCKER_CERT_PATH"):
-            logger.debug(export)
-            cert_path = export.split("=")[-1][1:-1]  # remove quotes
-        if export.startswith("DOCKER_HOST"):
-            logger.debug(export)
-            host = export.split("=")[-1]
-    if not tls or not cert_path or not host:
-        logger.debug(exports)
+    if not env_export:
         return False
-    env_['tls'] = tls
-    env_['cert_path'] = cert_path
-    env_['host'] = host
+    exports = dict((m.group(1), m.group(2)) for m in _ENV_EXPORT.finditer(env_export))
+    logger.debug(exports)
+    env_ = {}
+    for key, var in _ENV_KEYS:
+        if not exports.get(var):
+            return False
+        env_[key] = exports[var]
     return env_
 
+def aws_credentials():
+    """
+    Get the (access key, secret key) pair from the .boto config file
+    """
+    global _CREDENTIALS
+    if _CREDENTIALS is None:
+        config = ConfigParser.ConfigParser()
+        config.read([str(user_home + "/.boto")])
+        try:
+            access_key = config.get('Credentials', 'aws_access_key_id')
+            secret_key = config.get('Credentials', 'aws_secret_access_key')
+        except ConfigParser.Error:
+            access_key = secret_key = None
+
+        # Warn if no credentials
+        if access_key is None or secret_key is None:
+            logger.info("No AWS credentials set. Please set them in ~/.boto")
+            raise SystemExit
+        _CREDENTIALS = (access_key, secret_key)
+    return _CREDENTIALS
+
+def ec2_connection(region):
+    """
+    Get a boto EC2 connection for region, reused across calls and threads
+    """
+    import boto.ec2
+
+    with _EC2_LOCK:
+        if region not in _EC2:
+            _EC2[region] = boto.ec2.connect_to_region(region)
+        return _EC2[region]
+
 def create(vpc, region, zone, nodename, ami=None, securitygroup="docker-machine", capture=True, progress=None):
     """
     Launch an AWS instance
     """
+    access_key, secret_key = aws_credentials()
+    invalidate_env(nodename)  # a previous node may have had the same name
     try:
         out = local(("docker-machine create "
                      "--driver amazonec2 "
@@ -117,8 +266,8 @@ def create(vpc, region, zone, nodename, ami=None, securitygroup="docker-machine"
                      "--amazonec2-root-size 8 "
                      "--amazonec2-security-group %s "
                      "%s"
-                     "%s" % (AWS_ACCESS_KEY,
-                             AWS_SECRET_KEY,
+                     "%s" % (access_key,
+                             secret_key,
                              vpc,
                              region,
                              zone,
@@ -130,6 +279,7 @@ def create(vpc, region, zone, nodename, ami=None, securitygroup="docker-machine"
         if "Error" in out:
             append_log('Error creating %s, removing... The error was: %r' % (nodename, out))
             out = machine('rm -f %s' % nodename)
+            invalidate_env(nodename)
             append_log("Removed: %s" % out)
         else:
             append_log("Launched %s: %s" % (nodename, out))
@@ -140,14 +290,44 @@ def create(vpc, region, zone, nodename, ami=None, securitygroup="docker-machine"
     except FabricException as e:
         append_log('Exception creating %s, removing... The error was: %r' % (nodename, e))
         out = machine('rm -f %s' % nodename)
+        invalidate_env(nodename)
         append_log("Removed: %s" % out)
 
+def create_batch(vpc, region, zone, nodenames, ami=None, securitygroup="docker-machine", progress=None):
+    """
+    Launch a batch of AWS instances sharing the same settings, one after the other
+    """
+    for nodename in nodenames:
+        create(vpc, region, zone, nodename, ami=ami, securitygroup=securitygroup, progress=progress)
+
+def _run(program, cmd, capture=True):
+    """
+    Run program with the shell-quoted arguments in cmd, without a shell,
+    honoring fabric's shell_env, lcd and warn_only
+    """
+    try:
+        argv = [program] + shlex.split(cmd)
+    except ValueError as e:
+        raise FabricException("Error parsing %s arguments %r: %s" % (program, cmd, e))
+    logger.debug("local: %s" % " ".join(argv))
+    child_env = dict(os.environ)
+    child_env.update((k, str(v)) for k, v in env.shell_env.items())
+    pipe = subprocess.PIPE if capture else None
+    try:
+        proc = subprocess.Popen(argv, stdout=pipe, stderr=pipe, cwd=env.lcwd or None, env=child_env)
+        out, err = proc.communicate()
+    except OSError as e:
+        raise FabricException("Error running %s: %r" % (argv[0], e))
+    if proc.returncode != 0 and not env.warn_only:
+        raise FabricException("%s returned %d: %s" % (" ".join(argv), proc.returncode, (err or "").strip()))
+    return (out or "").strip()
+
 def docker(cmd, capture=True):
     """
     Run Docker command
     """
     try:
-        out = local("docker %s" % cmd, capture=capture)
+        out = _run("docker", cmd, capture=capture)
         return out
     except FabricException as e:
         append_log("Exception running docker: %r" % e)
@@ -157,7 +337,7 @@ def machine(cmd, capture=True, progress=None):
     Run Machine command
     """
     try:
-        out = local("docker-machine %s" % cmd, capture=capture)
+        out = _run("docker-machine", cmd, capture=capture)
         if progress:
             global completed
             completed += 1
@@ -172,14 +352,33 @@ def machine_list():
     """
     return machine("ls", capture=True)
 
+def machine_list_fmt():
+    """
+    List machines as a {name: url} dict, url being empty for machines not running
+    """
+    out = machine('ls --format "{{.Name}} {{.URL}}"', capture=True) or ""
+    machines = {}
+    for line in out.splitlines():
+        fields = line.split(None, 1)
+        if fields:
+            machines[fields[0]] = fields[1].strip() if len(fields) > 1 else ""
+    return machines
+
 def active(nodename):
     machine("active %s" % nodename)
 
 def pull(image):
     docker("pull %s" % image)
 
-def build(folder, tag):
-    docker("build -t %s %s" % (tag, folder))
+def build(folder, tag, cache_from=None, buildkit=False):
+    cache = ("--cache-from %s " % cache_from) if cache_from else ""
+    if not buildkit:
+        docker("build %s-t %s %s" % (cache, tag, folder))
+        return
+    # BuildKit needs Docker >= 18.09, inline cache metadata lets the image be used with --cache-from
+    # shell_env replaces env.shell_env, so keep any DOCKER_HOST etc. set by the caller
+    with shell_env(**dict(env.shell_env, DOCKER_BUILDKIT="1")):
+        docker("build --build-arg BUILDKIT_INLINE_CACHE=1 %s-t %s %s" % (cache, tag, folder))
 
 def run(name, image, options, command, capture=True):
     out = docker("run --name %s %s %s %s" % (name, options, image, command), capture=capture)
@@ -193,7 +392,7 @@ def stop(nodename, rm=True, capture=True):
         append_log("Removed: %s" % out)
 
 def exec_(container, command):
-    docker("exec -it %s %s", container, command)
+    docker("exec -it %s %s" % (container, command))
 
 def run_on(nodename, image, options="", command="", name=None, progress=None):
     if name is None:
@@ -249,12 +448,14 @@ def pull_on(nodename, image):
     with shell_env(DOCKER_TLS_VERIFY=env_['tls'], DOCKER_CERT_PATH=env_['cert_path'], DOCKER_HOST=env_['host']):
         pull(image)
 
-def build_on(nodename, folder, tag):
+def build_on(nodename, folder, tag, cache_from=None, buildkit=False):
     env_ = machine_env(nodename)
     if not env_:
         abort("Error getting machine environment")
     with shell_env(DOCKER_TLS_VERIFY=env_['tls'], DOCKER_CERT_PATH=env_['cert_path'], DOCKER_HOST=env_['host']):
-        build(folder, tag)
+        if cache_from:
+            pull(cache_from)  # a failed pull only means a cold build
+        build(folder, tag, cache_from=cache_from, buildkit=buildkit)
 
 def compose_on(nodename, command):
     env_ = machine_env(nodename)
@@ -267,6 +468,12 @@ def ssh_on(nodename, command):
     out = machine("ssh %s -- %s" % (nodename, command))
     return out
 
+def ssh_script_on(nodename, lines):
+    """
+    Run several commands in a single SSH session, stopping at the first failure
+    """
+    return ssh_on(nodename, pipes.quote(" && ".join(lines)))
+
 def scp_to(nodename, src, dest):
     env_ = machine_env(nodename)
     ip = env_['host'][6:-5]
@@ -282,8 +489,8 @@ def cleanup(containers):
     with settings(warn_only=True):
         for container in containers:
             docker("stop --time=30 %s" % container)
-            docker("rm $(docker ps -a -q)")
-            docker("rmi $(docker images -f 'dangling=true' -q)")
+        docker("container prune -f")
+        docker("image prune -f")
 
 def rm_data(nodename, progress=None):
     out = ssh_on(nodename, "sudo rm -rf /opt/data/*")
@@ -298,24 +505,20 @@ def cleanup_data(nodenames):
     """
     Remove instances
     """
-    max_workers = len(nodenames)
+    max_workers = min(MAX_WORKERS, len(nodenames))
 
     global completed
     completed = 0
-    progress = ProgressBar(widgets=widgets, maxval=max_workers).start()
+    progress = ProgressBar(widgets=widgets, maxval=len(nodenames)).start()
 
     start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_node = dict((executor.submit(rm_data,
-                                            nodename,
-                                            progress=progress), nodename)
-                           for nodename in nodenames)
-
-    for future in futures.as_completed(future_node, 30):
-        nodename = future_node[future]
+    executor = get_pool()
+    calls = ((nodename, partial(rm_data, nodename, progress=progress))
+             for nodename in nodenames)
+    for nodename, future in submit_bounded(executor, calls, max_workers):
         if future.exception() is not None:
             append_log('%r generated an exception' % nodename)
-        if future.result():
+        elif future.result():
             append_log("Data cleanup: %s" % future.result())
 
     progress.finish()
@@ -326,24 +529,23 @@ def teardown(nodenames):
     """
     Remove instances
     """
-    max_workers = len(nodenames)
+    max_workers = min(MAX_WORKERS, len(nodenames))
 
     global completed
     completed = 0
-    progress = ProgressBar(widgets=widgets, maxval=max_workers).start()
+    progress = ProgressBar(widgets=widgets, maxval=len(nodenames)).start()
+
+    for nodename in nodenames:
+        invalidate_env(nodename)
 
     start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_node = dict((executor.submit(machine,
-                                            "rm %s" % nodename,
-                                            progress=progress), nodename)
-                           for nodename in nodenames)
-
-    for future in futures.as_completed(future_node, 30):
-        nodename = future_node[future]
+    executor = get_pool()
+    calls = ((nodename, partial(machine, "rm %s" % nodename, progress=progress))
+             for nodename in nodenames)
+    for nodename, future in submit_bounded(executor, calls, max_workers):
         if future.exception() is not None:
             append_log('%r generated an exception' % nodename)
-        if future.result():
+        elif future.result():
             append_log("Teardown: %s" % future.result())
 
     progress.finish()
@@ -354,6 +556,7 @@ def launch_prepare_nodes(vpc, region, zone, clients=implementations):
     """
     Launch nodes to prepare AMIs using create()
     """
+    aws_credentials()  # fail before launching anything
     max_workers = len(clients)
 
     global completed
@@ -362,16 +565,19 @@ def launch_prepare_nodes(vpc, region, zone, clients=implementations):
 
     # Launch prepare nodes
     start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_client = dict((executor.submit(create, vpc, region, zone, "prepare-%s" % client,
-                                                 progress=progress), client)
-                                for client in clients)
-        progress.update(max_workers)
-
-    for future in futures.as_completed(future_to_client, 300):
-        client = future_to_client[future]
-        if future.exception() is not None:
-            logger.info('%s generated an exception: %r' % ("Launching prepare-%s" % client, future.exception()))
+    executor = get_pool()
+    future_to_client = dict((executor.submit(create, vpc, region, zone, "prepare-%s" % client,
+                                             progress=progress), client)
+                            for client in clients)
+    progress.update(max_workers)
+
+    try:
+        for future in futures.as_completed(future_to_client, PREPARE_LAUNCH_TIMEOUT):
+            client = future_to_client[future]
+            if future.exception() is not None:
+                logger.info('%s generated an exception: %r' % ("Launching prepare-%s" % client, future.exception()))
+    except futures.TimeoutError:
+        abandon(future_to_client, "Launching prepare nodes", PREPARE_LAUNCH_TIMEOUT)
 
     logger.info("Launch prepare duration: %ss" % (time.time() - start))
 
@@ -389,26 +595,29 @@ def prepare_nodes(region, zone, es, clients=implementations, images=None, dag=Fa
 
     # Run preparation tasks, extending base client images and creating new AMIs
     start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_client = dict((executor.submit(prepare_ami,
-                                                 region,
-                                                 zone,
-                                                 "prepare-%s" % client,
-                                                 es,
-                                                 client,
-                                                 image=images[client] if images else None,
-                                                 dag=dag,
-                                                 progress=progress), client)
-                                for client in clients)
-
-    for future in futures.as_completed(future_to_client, 1200):
-        client = future_to_client[future]
-        if future.exception() is not None:
-            logger.info('%s generated an exception: %r' % ("prepare-%s" % client, future.exception()))
-        else:
-            ami_id = future.result()
-            logger.info('%r returned: %s' % ("prepare-%s" % client, ami_id))
-            ami_ids[client] = ami_id
+    executor = get_pool()
+    future_to_client = dict((executor.submit(prepare_ami,
+                                             region,
+                                             zone,
+                                             "prepare-%s" % client,
+                                             es,
+                                             client,
+                                             image=images[client] if images else None,
+                                             dag=dag,
+                                             progress=progress), client)
+                            for client in clients)
+
+    try:
+        for future in futures.as_completed(future_to_client, PREPARE_TIMEOUT):
+            client = future_to_client[future]
+            if future.exception() is not None:
+                logger.info('%s generated an exception: %r' % ("prepare-%s" % client, future.exception()))
+            else:
+                ami_id = future.result()
+                logger.info('%r returned: %s' % ("prepare-%s" % client, ami_id))
+                ami_ids[client] = ami_id
+    except futures.TimeoutError:
+        abandon(future_to_client, "Preparing AMIs", PREPARE_TIMEOUT)
 
     # Save AMI IDs to file
     with open('amis.json', 'w') as f:
@@ -465,12 +674,9 @@ def setup_es(vpc, region, zone, user, passwd):
 
     # Get our node IP
     es = {}
-    machines = machine_list().splitlines()[1:]
-    for mach in machines:
-        fields = mach.split()
-        ip = fields[-1][6:-5]
-        if mach.startswith(nodename):
-            es['ip'] = ip
+    url = machine_list_fmt().get(nodename)
+    if url:
+        es['ip'] = urlparse(url).hostname
     if not es:
         abort("Could not find our ElasticSearch node, aborting...")
     progress.update(90)
@@ -485,38 +691,42 @@ def setup_es(vpc, region, zone, user, passwd):
     return es['ip']
 
 @task
-def launch_nodes(vpc, region, zone, ami_ids, nodes):
+def launch_nodes(vpc, region, zone, ami_ids, nodes, batch_size=None):
     """
     Launch bootnodes and testnodes using create()
     """
+    aws_credentials()  # fail before launching anything
     max_workers = len(nodes['cpp'] + nodes['go'] + nodes['python'])
 
     global completed
     completed = 0
     progress = ProgressBar(widgets=widgets, maxval=max_workers * 10).start()
 
+    # Group nodes sharing the same AMI into batches, each batch being launched
+    # sequentially by a single worker. Unless batch_size is given, each group
+    # gets its share of LAUNCH_WORKERS, so small clusters launch in one round
+    groups = defaultdict(list)
+    for impl in implementations:
+        for nodename in nodes[impl]:
+            groups[ami_ids[impl]].append(nodename)
+    group_workers = max(1, LAUNCH_WORKERS // max(1, len(groups)))
+    batches = []
+    for ami, nodenames in groups.items():
+        size = batch_size or int(math.ceil(len(nodenames) / float(group_workers)))
+        batches.extend((ami, nodenames[i:i + size]) for i in range(0, len(nodenames), size))
+
+    longest = max([len(batch) for ami, batch in batches] or [1])
+
     start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=12) as executor:
-        future_node = dict((executor.submit(create, vpc, region, zone, nodename,
-                                            ami=ami_ids['cpp'],
-                                            progress=progress), nodename)
-                           for nodename in nodes['cpp'])
-        future_node.update(dict((executor.submit(create, vpc, region, zone, nodename,
-                                                 ami=ami_ids['go'],
-                                                 progress=progress), nodename)
-                           for nodename in nodes['go']))
-        future_node.update(dict((executor.submit(create, vpc, region, zone, nodename,
-                                                 ami=ami_ids['python'],
-                                                 progress=progress), nodename)
-                           for nodename in nodes['python']))
-        progress.update(max_workers)
-
-    for future in futures.as_completed(future_node, 300):
-        nodename = future_node[future]
+    executor = get_pool()
+    calls = ((batch, partial(create_batch, vpc, region, zone, batch,
+                             ami=ami,
+                             progress=progress))
+             for ami, batch in batches)
+    progress.update(max_workers)
+    for batch, future in submit_bounded(executor, calls, LAUNCH_WORKERS, 300 * longest):
         if future.exception() is not None:
-            append_log('%s generated an exception: %r' % (nodename, future.exception()))
-        if future.result() and "Exception" not in future.result():
-            append_log('Launched %s: %r' % (nodename, future.result()))
+            append_log('%s generated an exception: %r' % (", ".join(batch), future.exception()))
 
     progress.finish()
     logger.info("Launch duration: %ss" % (time.time() - start))
@@ -600,12 +810,13 @@ def prepare_ami(region, zone, nodename, es, client, image=None, dag=False, progr
 
     # Stop the instance
     machine("stop %s" % nodename)
+    invalidate_env(nodename)  # the host changes if the machine is started again
     if progress:
         completed += 5
         progress.update(completed)
 
-    # Create EC2 connection with boto
-    ec2 = boto.ec2.connect_to_region(region)
+    # Get EC2 connection with boto
+    ec2 = ec2_connection(region)
 
     # Cleanup old AMIs
     images = ec2.get_all_images(filters={'tag:Name': "prepared-%s" % client})
@@ -617,31 +828,33 @@ def prepare_ami(region, zone, nodename, es, client, image=None, dag=False, progr
     ami_id = ec2.create_image(instance_id, "prepared-%s" % client, description="Prepared %s AMI" % client)
 
     # Tag new AMI
-    image = ec2.get_all_images(image_ids=ami_id)[0]
-    image.add_tag("Name", "prepared-%s" % client)
+    ec2.create_tags([ami_id], {"Name": "prepared-%s" % client})
     if progress:
         completed += 10
         progress.update(completed)
 
     # Wait until the image is ready
     logger.info("Waiting for AMI to be available")
-    while image.state == 'pending':
+    delay = 1
+    state = 'pending'
+    while state == 'pending':
         sys.stdout.write('.')
         sys.stdout.flush()
-        time.sleep(5)
-        image.update()
-    if image.state == 'available':
+        time.sleep(delay)
+        delay = min(delay * 2, 15)
+        state = ec2.get_all_images(image_ids=[ami_id])[0].state
+    if state == 'available':
         return ami_id
     else:
-        raise ValueError("Created AMI returned non-available state", image.state)
+        raise ValueError("Created AMI returned non-available state", state)
 
 def account_on(nodename, image, progress=None):
     """
     Run geth with 'account new' on a node
     """
     # Create password file
-    ssh_on(nodename, "sudo mkdir -p /opt/data")
-    ssh_on(nodename, "sudo touch /opt/data/password")
+    ssh_script_on(nodename, ["sudo mkdir -p /opt/data",
+                             "sudo touch /opt/data/password"])
 
     # Create account
     options = ("--volume /opt/data:/opt/data "
@@ -668,22 +881,17 @@ def create_accounts(nodenames, image):
     """
     Create geth accounts
     """
-    max_workers = len(nodenames)
+    max_workers = min(MAX_WORKERS, len(nodenames))
 
     global completed
     completed = 0
-    progress = ProgressBar(widgets=widgets, maxval=max_workers * 10).start()
+    progress = ProgressBar(widgets=widgets, maxval=len(nodenames) * 10).start()
 
     start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_node = dict((executor.submit(account_on,
-                                            nodename,
-                                            image,
-                                            progress=progress), nodename)
-                           for nodename in nodenames)
-
-    for future in futures.as_completed(future_node, 90):
-        nodename = future_node[future]
+    executor = get_pool()
+    calls = ((nodename, partial(account_on, nodename, image, progress=progress))
+             for nodename in nodenames)
+    for nodename, future in submit_bounded(executor, calls, max_workers):
         if future.exception() is not None:
             append_log('%r generated an exception: %s' % (nodename, future.exception()))
 
@@ -735,6 +943,8 @@ def import_key(nodename, privkey, image):
 
 @task
 def run_bootnodes(nodes, images):
+    import nodeid_tool
+
     options = dict()
     commands = dict()
     for impl in nodes:
@@ -752,7 +962,7 @@ def run_bootnodes(nodes, images):
                                       '--mode full '
                                       '--peers 25 '
                                       '--upnp off '
-                                      '--public-ip %s"' % (nodename, ip))
+                                      '--public-ip %s' % (nodename, ip))
             elif impl == 'go':
                 options[nodename] = ('-d -p 30303:30303 -p 30303:30303/udp '
                                      '--entrypoint geth')
@@ -779,41 +989,27 @@ def run_containers(nodes, images, options, commands):
         for client in implementations:
             images[client] = "ethereum/client-%s" % client
 
-    max_workers = len(nodes['cpp'] + nodes['go'] + nodes['python'])
+    num_nodes = len(nodes['cpp'] + nodes['go'] + nodes['python'])
+    max_workers = min(MAX_WORKERS, num_nodes)
 
     global completed
     completed = 0
-    progress = ProgressBar(widgets=widgets, maxval=max_workers * 10).start()
+    progress = ProgressBar(widgets=widgets, maxval=num_nodes * 10).start()
 
     start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_node = dict((executor.submit(run_on,
-                                            nodename,
-                                            images['cpp'],
-                                            options[nodename],
-                                            commands[nodename],
-                                            progress=progress), nodename)
-                           for nodename in nodes['cpp'])
-        future_node.update(dict((executor.submit(run_on,
-                                                 nodename,
-                                                 images['go'],
-                                                 options[nodename],
-                                                 commands[nodename],
-                                                 progress=progress), nodename)
-                           for nodename in nodes['go']))
-        future_node.update(dict((executor.submit(run_on,
-                                                 nodename,
-                                                 images['python'],
-                                                 options[nodename],
-                                                 commands[nodename],
-                                                 progress=progress), nodename)
-                           for nodename in nodes['python']))
-
-    for future in futures.as_completed(future_node, 90):
-        nodename = future_node[future]
+    executor = get_pool()
+    calls = ((nodename, partial(run_on,
+                                nodename,
+                                images[impl],
+                                options[nodename],
+                                commands[nodename],
+                                progress=progress))
+             for impl in implementations
+             for nodename in nodes[impl])
+    for nodename, future in submit_bounded(executor, calls, max_workers):
         if future.exception() is not None:
             append_log("Exception starting %s: %s" % (nodename, future.exception()))
-        if future.result() and "Exception" not in future.result():
+        elif future.result() and "Exception" not in future.result():
             append_log("Started: %s" % future.result())
 
     logger.info("Run duration: %ss" % (time.time() - start))
@@ -822,24 +1018,20 @@ def stop_containers(nodenames):
     """
     Stop client nodes on machines using stop_on()
     """
-    max_workers = len(nodenames)
+    max_workers = min(MAX_WORKERS, len(nodenames))
 
     global completed
     completed = 0
-    progress = ProgressBar(widgets=widgets, maxval=max_workers * 10).start()
+    progress = ProgressBar(widgets=widgets, maxval=len(nodenames) * 10).start()
 
     start = time.time()
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_node = dict((executor.submit(stop_on,
-                                            nodename,
-                                            progress=progress), nodename)
-                           for nodename in nodenames)
-
-    for future in futures.as_completed(future_node, 30):
-        nodename = future_node[future]
+    executor = get_pool()
+    calls = ((nodename, partial(stop_on, nodename, progress=progress))
+             for nodename in nodenames)
+    for nodename, future in submit_bounded(executor, calls, max_workers):
         if future.exception() is not None:
             append_log("Exception stopping %s: %s" % (nodename, future.exception()))
-        if future.result() and "Exception" not in future.result():
+        elif future.result() and "Exception" not in future.result():
             append_log("Stopped: %s" % future.result())
 
     progress.finish()
@@ -848,12 +1040,11 @@ def stop_containers(nodenames):
 @task
 def run_scenarios(scenarios, norun=False, testnet=False):
     """
-    Run test scenarios
+    Run test scenarios, sequentially in a single py.test run
     """
+    norun = "--norun " if norun else ""
+    testnet = "--testnet " if testnet else ""
     try:
-        for scenario in scenarios:
-            norun = "--norun " if norun else ""
-            testnet = "--testnet " if testnet else ""
-            local("py.test -vvrs %s%s%s" % (norun, testnet, scenario))
+        local("py.test -vvrs %s%s%s" % (norun, testnet, " ".join(scenarios)))
     except FabricException as e:
         append_log("Exception running scenarios: %r" % e)